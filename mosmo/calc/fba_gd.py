@@ -1,17 +1,33 @@
 """Flux Balance Analysis via gradient descent."""
 import abc
+import copy
+import functools
 import time
 from dataclasses import dataclass
-from typing import Any, Dict, Iterable, Mapping, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, Mapping, Optional, Sequence, Tuple, Union
 
 import jax
 import jax.numpy as jnp
 import numpy as np
 import scipy.optimize
+from jax.experimental import sparse
 
 from mosmo.model import Molecule, Reaction, Pathway
 
 ArrayT = Union[np.ndarray, jnp.ndarray]
+BoundsT = Tuple[ArrayT, ArrayT]
+TargetT = Union[float, Tuple[Optional[float], Optional[float]]]
+
+
+def _update_bounds(lb: np.ndarray, ub: np.ndarray, positions: Mapping[Any, int], targets: Mapping[Any, TargetT]):
+    """Updates lower and upper bounds in place, for any targets with a position in the bounds arrays."""
+    for item, target in targets.items():
+        i = positions.get(item)
+        if i is not None:
+            if target is None or isinstance(target, float) or isinstance(target, int):
+                target = (target, target)
+            lb[i] = target[0] if target[0] is not None else -np.inf
+            ub[i] = target[1] if target[1] is not None else np.inf
 
 
 class Objective(abc.ABC):
@@ -42,6 +58,15 @@ class Objective(abc.ABC):
         """Returns the current values of all adjustable params, suitable to pass to residual() or loss()."""
         return None
 
+    def updated_params(self, params: Any) -> Optional[ArrayT]:
+        """Returns params() as they would be after update_params(params), leaving this objective unchanged.
+
+        The default applies the update to a shallow copy. Subclasses that update params in place must override this.
+        """
+        objective = copy.copy(self)
+        objective.update_params(params)
+        return objective.params()
+
     @abc.abstractmethod
     def residual(self, velocities: ArrayT, dmdt: ArrayT, params: Optional[ArrayT]) -> ArrayT:
         """Returns a vector of residual values whose weighted aggregate value is to be minimized."""
@@ -57,7 +82,7 @@ class SteadyStateObjective(Objective):
     def __init__(self, network: Pathway, intermediates: Iterable[Molecule], weight: float = 1.0):
         super().__init__(weight)
         self.network = network
-        self.indices = np.array([network.molecules.index_of(m) for m in intermediates], dtype=np.int32)
+        self.indices = jnp.asarray(network.molecules.indices_of(intermediates), dtype=jnp.int32)
 
     def residual(self, velocities: ArrayT, dmdt: ArrayT, params=None) -> jnp.ndarray:
         """Ignores velocities; returns dM/dt values for all configured intermediates."""
@@ -70,12 +95,11 @@ class IrreversibilityObjective(Objective):
     def __init__(self, network: Pathway, weight: float = 1.0):
         super().__init__(weight)
         self.network = network
-        self.indices = np.array([i for i, reaction in enumerate(network.reactions) if not reaction.reversible],
-                                dtype=np.int32)
+        self.indices = jnp.asarray(np.flatnonzero(~network.reversible_mask), dtype=jnp.int32)
 
     def residual(self, velocities: ArrayT, dmdt: ArrayT, params=None) -> jnp.ndarray:
         """Returns value of any negative velocity, or 0 for positive velocity, for all irreversible reactions."""
-        return jnp.minimum(0, velocities[self.indices])
+        return -jax.nn.relu(-velocities[self.indices])
 
 
 class ProductionObjective(Objective):
@@ -91,34 +115,37 @@ class ProductionObjective(Objective):
 
     def __init__(self,
                  network: Pathway,
-                 targets: Mapping[Molecule, Union[float, Tuple[Optional[float], Optional[float]]]],
+                 targets: Mapping[Molecule, TargetT],
                  weight: float = 1.0):
         super().__init__(weight)
         self.network = network
-        self.indices = np.array([network.molecules.index_of(met) for met in targets], dtype=np.int32)
-        self.bounds = np.full((self.indices.shape[0], 2), [-np.inf, np.inf]).T
+        self.indices = jnp.asarray(network.molecules.indices_of(targets), dtype=jnp.int32)
+        self._positions = {met: i for i, met in enumerate(targets)}
+        # Lower and upper bounds are kept as separate contiguous arrays.
+        self.lb = np.full(self.indices.shape[0], -np.inf)
+        self.ub = np.full(self.indices.shape[0], np.inf)
         self.update_params(targets)
 
-    def update_params(self, targets: Mapping[Molecule, Union[float, Tuple[Optional[float], Optional[float]]]]):
+    def update_params(self, targets: Mapping[Molecule, TargetT]):
         """Updates some or all target dM/dt values."""
-        for i, met_idx in enumerate(self.indices):
-            met = self.network.molecules[met_idx]
-            if met in targets:
-                target = targets[met]
-                if isinstance(target, float) or isinstance(target, int):
-                    target = (target, target)
-                self.bounds[0][i] = target[0] if target[0] is not None else -np.inf
-                self.bounds[1][i] = target[1] if target[1] is not None else np.inf
+        _update_bounds(self.lb, self.ub, self._positions, targets)
 
-    def params(self) -> Optional[ArrayT]:
-        """Returns an array of shape (2, #targets) with lower and upper target bounds."""
-        return self.bounds
+    def updated_params(self, targets: Mapping[Molecule, TargetT]) -> BoundsT:
+        """Returns target bounds as they would be after update_params(targets), leaving this objective unchanged."""
+        lb, ub = self.lb.copy(), self.ub.copy()
+        _update_bounds(lb, ub, self._positions, targets)
+        return lb, ub
+
+    def params(self) -> BoundsT:
+        """Returns arrays of lower and upper target bounds, each of shape (#targets,)."""
+        return self.lb, self.ub
 
-    def residual(self, velocities: ArrayT, dmdt: ArrayT, bounds: ArrayT) -> jnp.ndarray:
+    def residual(self, velocities: ArrayT, dmdt: ArrayT, bounds: BoundsT) -> jnp.ndarray:
         """Calculates shortfall (as a negative) or excess dM/dt for select molecules vs target values or bounds."""
-        shortfall = jnp.minimum(0, dmdt[self.indices] - bounds[0])
-        excess = jnp.maximum(0, dmdt[self.indices] - bounds[1])
-        return shortfall + excess
+        # Equivalent to min(0, x - lb) + max(0, x - ub), but as a single fused operation.
+        x = dmdt[self.indices]
+        lb, ub = bounds
+        return x - jnp.clip(x, lb, ub)
 
 
 class VelocityObjective(Objective):
@@ -134,34 +161,37 @@ class VelocityObjective(Objective):
 
     def __init__(self,
                  network: Pathway,
-                 targets: Mapping[Reaction, Union[float, Tuple[Optional[float], Optional[float]]]],
+                 targets: Mapping[Reaction, TargetT],
                  weight: float = 1.0):
         super().__init__(weight)
         self.network = network
-        self.indices = np.array([network.reactions.index_of(rxn) for rxn in targets], dtype=np.int32)
-        self.bounds = np.full((self.indices.shape[0], 2), [-np.inf, np.inf]).T
+        self.indices = jnp.asarray(network.reactions.indices_of(targets), dtype=jnp.int32)
+        self._positions = {rxn: i for i, rxn in enumerate(targets)}
+        # Lower and upper bounds are kept as separate contiguous arrays.
+        self.lb = np.full(self.indices.shape[0], -np.inf)
+        self.ub = np.full(self.indices.shape[0], np.inf)
         self.update_params(targets)
 
-    def update_params(self, targets: Mapping[Reaction, Union[float, Tuple[Optional[float], Optional[float]]]]):
+    def update_params(self, targets: Mapping[Reaction, TargetT]):
         """Updates some or all target velocity values."""
-        for i, rxn_idx in enumerate(self.indices):
-            rxn = self.network.reactions[rxn_idx]
-            if rxn in targets:
-                target = targets[rxn]
-                if isinstance(target, float) or isinstance(target, int):
-                    target = (target, target)
-                self.bounds[0][i] = target[0] if target[0] is not None else -np.inf
-                self.bounds[1][i] = target[1] if target[1] is not None else np.inf
+        _update_bounds(self.lb, self.ub, self._positions, targets)
 
-    def params(self) -> Optional[ArrayT]:
-        """Returns an array of shape (2, #targets) with lower and upper target bounds."""
-        return self.bounds
+    def updated_params(self, targets: Mapping[Reaction, TargetT]) -> BoundsT:
+        """Returns target bounds as they would be after update_params(targets), leaving this objective unchanged."""
+        lb, ub = self.lb.copy(), self.ub.copy()
+        _update_bounds(lb, ub, self._positions, targets)
+        return lb, ub
+
+    def params(self) -> BoundsT:
+        """Returns arrays of lower and upper target bounds, each of shape (#targets,)."""
+        return self.lb, self.ub
 
-    def residual(self, velocities: ArrayT, dmdt: ArrayT, bounds: ArrayT) -> jnp.ndarray:
+    def residual(self, velocities: ArrayT, dmdt: ArrayT, bounds: BoundsT) -> jnp.ndarray:
         """Calculates shortfall (as a negative) or excess velocity for select reactions vs target values or bounds."""
-        shortfall = jnp.minimum(0, velocities[self.indices] - bounds[0])
-        excess = jnp.maximum(0, velocities[self.indices] - bounds[1])
-        return shortfall + excess
+        # Equivalent to min(0, x - lb) + max(0, x - ub), but as a single fused operation.
+        x = velocities[self.indices]
+        lb, ub = bounds
+        return x - jnp.clip(x, lb, ub)
 
 
 class ExclusionObjective(Objective):
@@ -173,12 +203,64 @@ class ExclusionObjective(Objective):
                  weight: float = 1.0):
         super().__init__(weight)
         self.network = network
-        self.indices = np.array([network.reactions.index_of(rxn) for rxn in reactions], dtype=np.int32)
+        self.indices = jnp.asarray(network.reactions.indices_of(reactions), dtype=jnp.int32)
 
     def residual(self, velocities: ArrayT, dmdt: ArrayT, params=None) -> jnp.ndarray:
         return jnp.prod(velocities[self.indices], keepdims=True)
 
 
+def _levenberg_marquardt(fun, jac, x0, args=(), max_nfev=1000, ftol=1e-8, xtol=1e-8):
+    """Minimizes sum(fun(x, *args)**2) by Levenberg-Marquardt, entirely within JAX.
+
+    Unlike scipy.optimize.least_squares, the whole optimization is a single jax.lax.while_loop, so under jax.jit there
+    is no round-trip to python (or from device to host) per iteration.
+
+    Args:
+        fun: residual function, fun(x, *args) -> vector.
+        jac: jacobian of fun, jac(x, *args) -> matrix.
+        x0: the starting point.
+        args: additional (traced) args to fun and jac.
+        max_nfev: the maximum number of iterations. Each iteration tries one step, evaluating fun once, and jac only if
+            the step is accepted. Note that this is not the same count as max_nfev for least_squares().
+        ftol: tolerance for termination by relative change in cost.
+        xtol: tolerance for termination by relative step size.
+
+    Returns:
+        (x, cost, nfev), where cost is the sum of squared residuals at x and nfev is the number of iterations.
+    """
+
+    def cond(state):
+        nfev, done = state[-2:]
+        return jnp.logical_and(nfev < max_nfev, jnp.logical_not(done))
+
+    def body(state):
+        x, r, j, c, damping, nfev, _ = state
+        jtj = j.T @ j
+        dx = -jnp.linalg.solve(jtj + damping * jnp.eye(jtj.shape[0], dtype=jtj.dtype), j.T @ r)
+        x_new = x + dx
+        r_new = fun(x_new, *args)
+        c_new = jnp.dot(r_new, r_new)
+
+        # Accept only improving steps, and adjust damping toward Gauss-Newton (accepted) or gradient descent (rejected).
+        # The residual and jacobian carry over unchanged from a rejected step.
+        accept = c_new < c
+        converged = jnp.logical_or(
+            jnp.logical_and(accept, c - c_new <= ftol * c),
+            jnp.linalg.norm(dx) <= xtol * (xtol + jnp.linalg.norm(x)))
+        x, r, j = jax.lax.cond(accept, lambda: (x_new, r_new, jac(x_new, *args)), lambda: (x, r, j))
+        return (x, r, j,
+                jnp.where(accept, c_new, c),
+                jnp.where(accept, damping / 3, damping * 2),
+                nfev + 1,
+                converged)
+
+    x0 = jnp.asarray(x0)
+    r0 = fun(x0, *args)
+    x, _, _, c, _, nfev, _ = jax.lax.while_loop(
+        cond, body, (x0, r0, jac(x0, *args), jnp.dot(r0, r0), jnp.asarray(1e-3, x0.dtype), 0, False))
+    return x, c, nfev
+
+
 @dataclass
 class FbaResult:
     """Reaction velocities and dm/dt for an FBA solution, with fitness metric."""
@@ -240,28 +322,58 @@ class FbaGd:
         # Additional objectives are defined by the caller
         self.objectives.update(objectives)
 
+        # The S matrix is typically very sparse, so the jitted functions use a sparse representation. One-off
+        # calculations on the host are faster with scipy's CSR format.
+        self._s_bcoo = sparse.BCOO.from_scipy_sparse(self.network.sparse_s_matrix)
+        self._s_csr = self.network.sparse_s_matrix
+
         # The loss function takes objective params as explicit arguments so jax.jit will not fold them into constants
         def residual(v, *params):
-            dmdt = self.network.s_matrix @ v
+            dmdt = self._s_bcoo @ v
             return jnp.concatenate(
                 [objective.residual(v, dmdt, p) for objective, p in zip(self.objectives.values(), params)])
 
+        # Forward-mode differentiation takes one pass per input (reaction), and reverse-mode one pass per output
+        # (residual). Use whichever is cheaper for the shape of this problem.
+        params = tuple(objective.params() for objective in self.objectives.values())
+        n_residuals = jax.eval_shape(residual, np.zeros(self.network.shape[1]), *params).shape[0]
+        jacobian = jax.jacrev(residual) if n_residuals < self.network.shape[1] else jax.jacfwd(residual)
+
         # Cache the jitted loss and jacobian functions
         self._residual_jit = jax.jit(residual)
-        self._residual_jac = jax.jit(jax.jacfwd(residual))
+        self._residual_jac = jax.jit(jacobian)
+
+        # Cache the fully jitted solver as well, for solve(backend='jax'), plus a vectorized version for solve_batch().
+        # The latter vectorizes over starting points, and optionally over params (params_axis=0) as well.
+        def solve_lm(v0, params, **kwargs):
+            return _levenberg_marquardt(residual, jacobian, v0, params, **kwargs)
+
+        self._solve_jit = jax.jit(solve_lm, static_argnames=['max_nfev', 'ftol', 'xtol'])
+        self._solve_batch_jit = jax.jit(
+            lambda v0s, params, params_axis=None, **kwargs: jax.vmap(
+                functools.partial(solve_lm, **kwargs), in_axes=(0, params_axis))(v0s, params),
+            static_argnames=['params_axis', 'max_nfev', 'ftol', 'xtol'])
 
     def update_params(self, updates):
         for name, params in updates.items():
             self.objectives[name].update_params(params)
 
-    def solve(self, v0: Optional[ArrayT] = None, seed: Optional[jax.random.PRNGKey] = None, **kw_args) -> FbaResult:
+    def solve(self,
+              v0: Optional[ArrayT] = None,
+              seed: Optional[jax.random.PRNGKey] = None,
+              backend: str = 'scipy',
+              **kw_args) -> FbaResult:
         """Solves the FBA problem as currently specified.
 
         Args:
             v0: a vector of velocities used as a starting point for optimization
             seed: random seed used to generate v0 if none is provided. Ignored if v0 is provided. If neither v0 nor
                 seed is provided, a suitable random seed is chosen.
-            kw_args: additional keyword args passed through to the underlying scipy.optimize.least_squares()
+            backend: 'scipy' to optimize via scipy.optimize.least_squares(), or 'jax' to run a Levenberg-Marquardt
+                optimization entirely within a single jit-compiled JAX function. The latter avoids per-iteration
+                python overhead, which dominates for small and medium networks.
+            kw_args: additional keyword args passed through to the underlying optimizer; for backend='jax' these are
+                limited to max_nfev, ftol, and xtol.
 
         Returns:
             FbaResult specifying the solution.
@@ -271,14 +383,82 @@ class FbaGd:
                 seed = jax.random.PRNGKey(int(time.time() * 1000))
             v0 = jax.random.normal(seed, self.network.shape[1:])
 
-        params = tuple(objective.params() for objective in self.objectives.values())
-        soln = scipy.optimize.least_squares(fun=self._residual_jit, args=params, x0=v0, jac=self._residual_jac,
-                                            **kw_args)
+        params = self._params()
+        if backend == 'scipy':
+            x = scipy.optimize.least_squares(fun=self._residual_jit, args=params, x0=v0, jac=self._residual_jac,
+                                             **kw_args).x
+        elif backend == 'jax':
+            x, _, _ = self._solve_jit(jnp.asarray(v0), params, **kw_args)
+        else:
+            raise ValueError(f"Unknown backend [{backend}]")
 
-        dmdt = self.network.s_matrix @ soln.x
-        fit_residual = np.concatenate(
-            [self.objectives[name].residual(soln.x, dmdt, None) for name in ['steady-state', 'irreversibility']])
+        dmdt = self._s_csr @ np.asarray(x)
         return FbaResult(v0=np.asarray(v0),
-                         velocities=np.asarray(soln.x),
+                         velocities=np.asarray(x),
                          dmdt=np.asarray(dmdt),
-                         fit=float(np.sum(np.square(fit_residual))))
+                         fit=self._fit(x, dmdt))
+
+    def solve_batch(self,
+                    v0s: Optional[ArrayT] = None,
+                    num_starts: int = 10,
+                    seed: Optional[jax.random.PRNGKey] = None,
+                    updates: Optional[Sequence[Mapping[str, Any]]] = None,
+                    **kw_args) -> FbaResult:
+        """Solves the FBA problem from multiple starting points at once, e.g. for random restarts.
+
+        All optimizations run in parallel as a single jit-compiled, vectorized JAX function, using the same algorithm
+        as solve(backend='jax'). Optionally, each starting point can also have its own objective params, to solve many
+        variants of the same problem (e.g. with different targets) at once.
+
+        Args:
+            v0s: an array of shape (#starts, #reactions), with one vector of velocities per starting point
+            num_starts: the number of random starting points to generate. Ignored if v0s or updates is provided.
+            seed: random seed used to generate v0s if none are provided. Ignored if v0s is provided. If neither v0s nor
+                seed is provided, a suitable random seed is chosen.
+            updates: params for each variant of the problem, in the same form as update_params(), and applied on top
+                of the current params. The current params themselves are unchanged. One starting point per variant.
+            kw_args: max_nfev, ftol, and/or xtol, passed through to the underlying optimizer.
+
+        Returns:
+            FbaResult where every attribute has an additional leading axis, with one entry per starting point.
+        """
+        if updates is not None:
+            if v0s is not None and len(v0s) != len(updates):
+                raise ValueError(f"Got {len(v0s)} starting points for {len(updates)} updates; expected one per update")
+            num_starts = len(updates)
+            params = self._batch_params(updates)
+            params_axis = 0
+        else:
+            params = self._params()
+            params_axis = None
+
+        if v0s is None:
+            if seed is None:
+                seed = jax.random.PRNGKey(int(time.time() * 1000))
+            v0s = jax.random.normal(seed, (num_starts,) + self.network.shape[1:])
+
+        xs, _, _ = self._solve_batch_jit(jnp.asarray(v0s), params, params_axis=params_axis, **kw_args)
+        xs = np.asarray(xs)
+        dmdts = (self._s_csr @ xs.T).T
+        return FbaResult(v0=np.asarray(v0s),
+                         velocities=xs,
+                         dmdt=dmdts,
+                         fit=np.array([self._fit(x, dmdt) for x, dmdt in zip(xs, dmdts)]))
+
+    def _params(self):
+        """Current params of all objectives, transferred to the device once rather than on every call."""
+        return jax.tree_util.tree_map(jnp.asarray, tuple(objective.params() for objective in self.objectives.values()))
+
+    def _batch_params(self, updates: Sequence[Mapping[str, Any]]):
+        """Params of all objectives for each of a sequence of updates, stacked along a new leading axis."""
+        batch = []
+        for update in updates:
+            batch.append(tuple(objective.updated_params(update[name]) if name in update else objective.params()
+                               for name, objective in self.objectives.items()))
+        return jax.tree_util.tree_map(lambda *values: jnp.asarray(np.stack(values)), *batch)
+
+    def _fit(self, velocities: np.ndarray, dmdt: np.ndarray) -> float:
+        """Sum of squared residuals of the universal fitness objectives (steady-state and irreversibility)."""
+        fit_residual = np.concatenate(
+            [self.objectives[name].residual(velocities, dmdt, None) for name in ['steady-state', 'irreversibility']])
+        return float(np.dot(fit_residual, fit_residual))
@@ -16,13 +16,18 @@ In general, $pK_a$ is measured, but $k_f$ and $k_b$ are not independently known.
 we assume a constant value for $k_b$, with the rationale that it is dominated by the frequency of collision with $H^+$
 (or $H_3O^+$).
 """
+import functools
+import itertools
+import warnings
 from dataclasses import dataclass
-from typing import Iterable, Mapping, Sequence
+from typing import Iterable, Mapping, Optional, Sequence, Tuple
 
 import jax
 import jax.numpy as jnp
 import numpy as np
-from scipy import integrate, optimize
+from numpy.typing import DTypeLike
+from scipy import integrate, optimize, sparse
+from scipy.sparse import linalg
 
 from mosmo.model import Molecule
 
@@ -36,6 +41,83 @@ WATER = Molecule(id='WATER', name='water', shorthand='H2O', charge=0)
 DEFAULT_KBACK = 1e9  # TODO: reference/justification for this value
 
 
+# Jitted kernels are defined at module level, with all buffer parameters passed as explicit arguments. So JAX compiles
+# each one once per shape and dtype, and shares the compiled code across all PhBuffer instances of the same size.
+def _rates(state: jnp.ndarray, kf: jnp.ndarray, kb: jnp.ndarray, acids: jnp.ndarray, bases: jnp.ndarray) -> jnp.ndarray:
+    """Instantaneous rates of all dissociation reactions, given a state vector."""
+    return kf * state[acids] - kb * state[0] * state[bases]
+
+
+def _dstate_dt(rates: jnp.ndarray, acids: jnp.ndarray, bases: jnp.ndarray, n_species: int) -> jnp.ndarray:
+    """Net effect of a vector of dissociation rates on each species."""
+    # Equivalent to s_matrix @ rates, but as scatter-adds over the three nonzero values per reaction. For buffers of
+    # a handful of species the two are indistinguishable, but for hundreds of species, jacobians via jacfwd of the
+    # sparse form run ~2x faster.
+    return (jnp.zeros(n_species, dtype=rates.dtype)
+            .at[acids].add(-rates)  # each dissociation consumes the acid
+            .at[bases].add(rates)  # each dissociation produces the base
+            .at[0].add(rates.sum())  # each dissociation produces a proton
+            .at[2].set(0))  # nothing affects the constant activity of the solvent
+
+
+def _dynamics(
+        state: jnp.ndarray, kf: jnp.ndarray, kb: jnp.ndarray, acids: jnp.ndarray, bases: jnp.ndarray) -> jnp.ndarray:
+    """Instantaneous rate of change of each species, given a state vector."""
+    return _dstate_dt(_rates(state, kf, kb, acids, bases), acids, bases, state.shape[0])
+
+
+def _equilibrium_residual(x: jnp.ndarray, state0: jnp.ndarray, params: Tuple[jnp.ndarray, ...]) -> jnp.ndarray:
+    # x is a vector of dissociations at each site; i.e. convert x[i] molecules of acids[i] into x[i] molecules of
+    # bases[i] plus x[i] protons. (least_squares always works in float64.)
+    _, _, acids, bases = params
+    x = x.astype(state0.dtype)
+    state = state0 + _dstate_dt(x, acids, bases, state0.shape[0])
+    # At steady state, all dstate_dt values are zero
+    return _dynamics(state, *params)
+
+
+def _titrate_residual(
+        x: jnp.ndarray, state0: jnp.ndarray, params: Tuple[jnp.ndarray, ...], mask: jnp.ndarray) -> jnp.ndarray:
+    # x is a vector of dissociations at each site, but holding protons constant. So convert x[i] molecules of
+    # acids[i] into x[i] molecules of bases[i] but ignore changes to [H+] itself (i.e. mask is zero at H+).
+    _, _, acids, bases = params
+    x = x.astype(state0.dtype)
+    state = state0 + _dstate_dt(x, acids, bases, state0.shape[0]) * mask
+    # At steady state, all dstate_dt values are zero. Omit H+ and water: the water row is always zero, and the remaining
+    # rows are only all zero if every rate is zero, which implies the H+ row (the sum of all rates) is too.
+    dydt = _dynamics(state, *params)
+    return jnp.concatenate([dydt[1:2], dydt[3:]])
+
+
+_equilibrium_residual_jit = jax.jit(_equilibrium_residual)
+_equilibrium_residual_jac = jax.jit(jax.jacfwd(_equilibrium_residual))
+_titrate_residual_jit = jax.jit(_titrate_residual)
+_titrate_residual_jac = jax.jit(jax.jacfwd(_titrate_residual))
+
+
+@functools.lru_cache(maxsize=None)
+def _diffrax_solver():
+    """Jit-compiled diffrax integration of _dynamics. Built on first use, since diffrax is an optional dependency."""
+    import diffrax
+
+    def solve(y0, ts, params, rtol, atol, max_steps):
+        return diffrax.diffeqsolve(
+            diffrax.ODETerm(lambda t, y, args: _dynamics(y, *args)),
+            diffrax.Kvaerno5(),
+            t0=0.,
+            t1=ts[-1],
+            dt0=1e-9,  # pH is fast
+            y0=y0,
+            args=params,
+            saveat=diffrax.SaveAt(ts=ts),
+            stepsize_controller=diffrax.PIDController(rtol=rtol, atol=atol),
+            max_steps=max_steps,
+            throw=False,
+        )
+
+    return jax.jit(solve, static_argnames=['max_steps'])
+
+
 @dataclass
 class ProtonationSequence:
     """Represents a series of molecular species resulting from sequential protonation of a single core.
@@ -66,37 +148,89 @@ class PhBuffer:
         acids: the index in `species` of the acid (protonated) form for each protonation site.
         bases: the index in `species` of the base (deprotonated) form for each protonation site.
         kf: forward rate constant, for dissociation (first-order) of the proton at each protonation site.
-        kb: back rate constant, for association (second-order) of the proton at each protonation site.
+        kb: back rate constant, for association (second-order) of the proton, shared by all protonation sites.
+        dtype: floating point type of all state and rate values.
+        jac_sparsity: sparse boolean matrix marking the structurally nonzero entries of the jacobian of dynamics().
     """
 
-    def __init__(self, components: Iterable[ProtonationSequence]):
-        species = [PROTON, HYDROXYL, WATER]
-        bases = [1]  # i.e. base=HYDROXYL, acid=WATER
-        p_kas = [14.]
-        offset = 3
+    def __init__(self, components: Iterable[ProtonationSequence], dtype: DTypeLike = np.float64):
+        """Initializes the buffer system.
 
-        for component in components:
-            species.extend(component.species)
-            p_kas.extend(component.p_kas)
-            bases.extend(range(offset, offset + len(component.p_kas)))
-            offset = offset + len(component.species)
+        Args:
+            components: the buffer components, each with one or more protonation sites.
+            dtype: floating point type of all state and rate values. With float32, titrate() still matches float64 to
+                within ~1e-4 (relative), but equilibrium() resolves pH and buffer species only to within ~1%, and trace
+                species such as [OH-] near neutral pH not at all. JAX computes in float32 regardless unless
+                jax_enable_x64 is set.
+        """
+        components = list(components)
+        species = [PROTON, HYDROXYL, WATER]
+        species.extend(s for component in components for s in component.species)
+        p_kas = np.fromiter(itertools.chain([14.], *(component.p_kas for component in components)), dtype=float)
+
+        # Within each component, site i has species[i] as its base. So the base of every site is the position of its
+        # component's first species, plus the site's position within the component.
+        species_counts = np.array([len(component.species) for component in components], dtype=int)
+        site_counts = np.array([len(component.p_kas) for component in components], dtype=int)
+        first_species = 3 + np.cumsum(species_counts) - species_counts
+        first_site = np.cumsum(site_counts) - site_counts
+        site_offsets = np.arange(site_counts.sum()) - np.repeat(first_site, site_counts)
+        bases = np.repeat(first_species, site_counts) + site_offsets
 
         self.species = species
-        self.bases = np.array(bases)
+        self._positions = {s: i for i, s in enumerate(species)}
+        self.bases = np.concatenate([[1], bases])  # i.e. base=HYDROXYL, acid=WATER
         self.acids = self.bases + 1
 
-        kas = np.power(10, -np.array(p_kas))
-        self.kf = kas * DEFAULT_KBACK
-        self.kb = np.full_like(self.kf, DEFAULT_KBACK)
-
-        # Use an S matrix just like any other reaction network. Note an extensive attempt to skip the S matrix and
-        # optimize calculations based on the known structure actually ran ~50% slower. Stick with the matrix math.
-        self.s_matrix = np.zeros((len(species), len(kas)))
-        cols = np.arange(self.s_matrix.shape[1])
-        self.s_matrix[self.acids, cols] = -1  # each dissociation consumes the acid
-        self.s_matrix[self.bases, cols] = 1  # each dissociation produces the base
-        self.s_matrix[0, cols] = 1  # each dissociation produces a proton
-        self.s_matrix[2, cols] = 0  # nothing affects the constant activity of the solvent
+        kas = np.power(10, -p_kas)
+        self.dtype = np.dtype(dtype)
+        self.kf = (kas * DEFAULT_KBACK).astype(self.dtype)
+        self.kb = self.dtype.type(DEFAULT_KBACK)  # the same for all sites; see module docstring
+
+        # Use an S matrix just like any other reaction network, for calculations on the host. Jitted calculations use
+        # the known structure directly (see _dstate_dt). There are exactly three nonzeros per reaction, so store it
+        # sparse.
+        n_sites = len(kas)
+        rows = np.concatenate([self.acids, self.bases, np.zeros_like(self.bases)])
+        cols = np.tile(np.arange(n_sites), 3)
+        data = np.repeat(np.array([-1, 1, 1], dtype=self.dtype), n_sites)  # acid consumed; base, proton produced
+        solvent = rows == 2  # nothing affects the constant activity of the solvent
+        self._s_csr = sparse.csr_matrix(
+            (data[~solvent], (rows[~solvent], cols[~solvent])), shape=(len(species), n_sites))
+        # Titration holds [H+] constant, so dissociations affect every species except H+.
+        titrate = ~solvent & (rows != 0)
+        self._titrate_s = sparse.csr_matrix(
+            (data[titrate], (rows[titrate], cols[titrate])), shape=(len(species), n_sites))
+        self._titrate_mask = np.ones(len(species), dtype=self.dtype)
+        self._titrate_mask[0] = 0
+        self._s_dense = None
+
+        # The jacobian of the dynamics is S @ dv/dy, where dv/dy has exactly three nonzero values per reaction: in
+        # columns H+, base, and acid (in that order, since bases[i] = acids[i] - 1). Precompute the sparsity pattern.
+        self._dvdy_indices = np.column_stack([np.zeros_like(self.bases), self.bases, self.acids]).ravel()
+        self._dvdy_indptr = np.arange(0, 3 * n_sites + 1, 3)
+
+        # Structural nonzeros of the jacobian, for solvers that estimate it by finite differences.
+        dvdy_pattern = sparse.csr_matrix(
+            (np.ones_like(self._dvdy_indices), self._dvdy_indices, self._dvdy_indptr), shape=self._s_csr.T.shape)
+        self.jac_sparsity = sparse.csr_matrix(abs(self._s_csr) @ dvdy_pattern != 0)
+
+        # Parameters of the jitted kernels. The starting state is passed explicitly rather than captured in a closure,
+        # so that repeated calls from different starting points reuse the same compiled functions.
+        self._params = (jnp.asarray(self.kf), jnp.asarray(self.kb), jnp.asarray(self.acids), jnp.asarray(self.bases))
+        self._equilibrium_residual = functools.partial(_equilibrium_residual_jit, params=self._params)
+        self._equilibrium_residual_jac = functools.partial(_equilibrium_residual_jac, params=self._params)
+        self._titrate_residual = functools.partial(
+            _titrate_residual_jit, params=self._params, mask=jnp.asarray(self._titrate_mask))
+        self._titrate_residual_jac = functools.partial(
+            _titrate_residual_jac, params=self._params, mask=jnp.asarray(self._titrate_mask))
+
+    @property
+    def s_matrix(self) -> np.ndarray:
+        """Dense stoichiometry matrix of the dissociation reactions, species x sites. Computed on first access."""
+        if self._s_dense is None:
+            self._s_dense = self._s_csr.toarray()
+        return self._s_dense
 
     def state_vector(self, concs: Mapping[Molecule, float], pH: float) -> jnp.ndarray:
         """Packs a lookup of molecule concentrations into an array, for efficient calculations.
@@ -109,84 +243,183 @@ class PhBuffer:
         Returns:
             An array collinear with self.species
         """
-        values = [concs.get(species, 0) for species in self.species]
-        # H+ and OH- are determined by pH. Water (solvent) has constant activity set to 1.
-        values[:3] = [pow(10, -pH), pow(10, pH - 14), 1]
+        values = np.zeros(len(self.species) - 3, dtype=self.dtype)
+        for species, conc in concs.items():
+            i = self._positions.get(species)
+            if i is not None and i >= 3:
+                values[i - 3] = conc
+        return self.state_from_array(values, pH)
+
+    def state_from_array(self, concs: np.ndarray, pH: float) -> jnp.ndarray:
+        """Builds a state vector from an array of buffer concentrations, bypassing any lookup by molecule.
+
+        Args:
+            concs: Concentrations of all buffer species, collinear with self.species[3:] (i.e. excluding H+, OH-, and
+                water).
+            pH: the current pH of the system. Determines concentrations of the first two species, H+ and OH-.
+
+        Returns:
+            An array collinear with self.species
+        """
+        concs = np.asarray(concs)
+        if concs.shape != (len(self.species) - 3,):
+            raise ValueError(f"Expected concs of shape ({len(self.species) - 3},), got {concs.shape}")
+        values = np.empty(len(self.species), dtype=self.dtype)
+        # H+ and OH- are determined by pH. Water (solvent) has constant activity set to 1 (i.e. 10^0).
+        values[:3] = np.power(10., [-pH, pH - 14, 0])
+        values[3:] = concs
         return jnp.array(values)
 
     def rates(self, state: jnp.ndarray) -> jnp.ndarray:
         """Instantaneous rates of all dissociation reactions, given a state vector."""
-        h_conc = state[0]
-        vf = self.kf * state[self.acids]
-        vb = self.kb * h_conc * state[self.bases]
-        return vf - vb
+        return _rates(state, *self._params)
 
     def dstate_dt(self, rates: jnp.ndarray) -> jnp.ndarray:
         """Calculates the net effect of a vector of reaction rates on each species in the system."""
-        dstate_dt = self.s_matrix @ rates
-        return dstate_dt
-
-    def equilibrium(self, concs: Mapping[Molecule, float], pH: float = 7.0, **kwargs) -> Mapping[Molecule, float]:
-        """Find equilibrium from a given set of starting concentrations."""
-        state0 = self.state_vector(concs, pH)
-
-        def residual(x):
-            # x is a vector of dissociations at each site; i.e. convert x[i] molecules of acids[i] into x[i]
-            # molecules of bases[i] plus x[i] protons.
-            state = state0 + self.dstate_dt(x)
-            # At steady state, all dstate_dt values are zero
-            return self.dstate_dt(self.rates(state))
-
-        soln = optimize.least_squares(
-            fun=jax.jit(residual),
-            jac=jax.jit(jax.jacfwd(residual)),
-            x0=jnp.zeros_like(self.kf),
-            **kwargs
-        )
-        state = state0 + self.dstate_dt(soln.x)
-        return dict(zip(self.species, np.asarray(state)))
+        return _dstate_dt(rates, self._params[2], self._params[3], len(self.species))
+
+    def dynamics(self, state: jnp.ndarray) -> jnp.ndarray:
+        """Instantaneous rate of change of each species in the system, given a state vector."""
+        return _dynamics(state, *self._params)
+
+    def _dynamics_host(self, state: np.ndarray) -> np.ndarray:
+        """Same as dynamics(), in plain numpy.
+
+        solve_ivp() calls its rate function once per step, with a small state vector. At that size, the fixed overhead
+        of dispatching to a jitted JAX function outweighs the calculation itself.
+        """
+        rates = self.kf * state[self.acids] - self.kb * state[0] * state[self.bases]
+        return self._s_csr @ rates
+
+    def jacobian(self, state: np.ndarray) -> sparse.csr_matrix:
+        """Analytic jacobian of dynamics() as a sparse matrix, given a state vector."""
+        # d(vf - vb)/d[H+] = -kb [A-]; d(vf - vb)/d[A-] = -kb [H+]; d(vf - vb)/d[HA] = kf
+        dvdy = np.column_stack(
+            [-self.kb * state[self.bases], np.full_like(self.kf, -self.kb * state[0]), self.kf]).ravel()
+        dvdy = sparse.csr_matrix((dvdy, self._dvdy_indices, self._dvdy_indptr), shape=self._s_csr.T.shape)
+        return self._s_csr @ dvdy
+
+    def equilibrium(self,
+                    concs: Mapping[Molecule, float],
+                    pH: float = 7.0,
+                    x0: Optional[np.ndarray] = None,
+                    **kwargs) -> Mapping[Molecule, float]:
+        """Find equilibrium from a given set of starting concentrations.
+
+        Args:
+            concs: starting concentrations of molecules in the buffer system.
+            pH: starting pH.
+            x0: initial guess for the net dissociation at each site, e.g. from a closely related problem in a sweep.
+                Defaults to zero.
+            kwargs: additional keyword args passed through to least_squares().
+        """
+        # Every iteration of least_squares passes small arrays to and from python. Keep them on the host CPU.
+        with jax.default_device(jax.devices('cpu')[0]):
+            state0 = self.state_vector(concs, pH)
+            soln = optimize.least_squares(
+                fun=self._equilibrium_residual,
+                jac=self._equilibrium_residual_jac,
+                x0=np.zeros_like(self.kf) if x0 is None else x0,
+                args=(state0,),
+                **kwargs
+            )
+        state = np.asarray(state0) + self._s_csr @ soln.x
+        return dict(zip(self.species, state))
 
     def titrate(self, concs: Mapping[Molecule, float], pH: float, **kwargs) -> Mapping[Molecule, float]:
-        """Find equilibrium from a given set of starting concentrations, holding pH constant."""
-        state0 = self.state_vector(concs, pH)
-
-        def residual(x):
-            # x is a vector of dissociations at each site, but holding protons constant. So convert x[i] molecules of
-            # acids[i] into x[i] molecules of bases[i] but ignore changes to [H+] itself.
-            state = state0 + self.dstate_dt(x).at[0].set(0)
-            # At steady state, all dstate_dt values are zero
-            return self.dstate_dt(self.rates(state))
-
-        soln = optimize.least_squares(
-            fun=jax.jit(residual),
-            jac=jax.jit(jax.jacfwd(residual)),
-            x0=jnp.zeros_like(self.kf),
-            **kwargs
-        )
-        state = state0 + self.dstate_dt(jnp.asarray(soln.x)).at[0].set(0)
-        return dict(zip(self.species, np.asarray(state)))
+        """Find equilibrium from a given set of starting concentrations, holding pH constant.
+
+        With [H+] fixed, all rates are linear in the dissociations, and equilibrium is the solution of a square sparse
+        linear system (i.e. a single, exact Newton step). Falls back to least_squares, with any given kwargs, if that
+        system is singular.
+        """
+        state0 = np.asarray(self.state_vector(concs, pH))
+        dissociations = self._titrate_direct(state0)
+        if dissociations is None:
+            # Every iteration of least_squares passes small arrays to and from python. Keep them on the host CPU.
+            with jax.default_device(jax.devices('cpu')[0]):
+                soln = optimize.least_squares(
+                    fun=self._titrate_residual,
+                    jac=self._titrate_residual_jac,
+                    x0=np.zeros_like(self.kf),
+                    args=(jnp.asarray(state0),),
+                    **kwargs
+                )
+            dissociations = soln.x
+        state = state0 + self._titrate_s @ dissociations
+        return dict(zip(self.species, state))
+
+    def _titrate_direct(self, state0: np.ndarray) -> Optional[np.ndarray]:
+        """Solves for the dissociations at each site that bring all rates to zero at constant [H+], if possible."""
+        # v(state0 + Tx) = v(state0) + (dv/dy)(T x), where dv/dy omits the H+ column since [H+] is constant.
+        h_conc = state0[0]
+        v0 = self.kf * state0[self.acids] - self.kb * h_conc * state0[self.bases]
+        dvdy = np.column_stack([np.zeros_like(self.kf), np.full_like(self.kf, -self.kb * h_conc), self.kf]).ravel()
+        dvdy = sparse.csr_matrix((dvdy, self._dvdy_indices, self._dvdy_indptr), shape=self._s_csr.T.shape)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', linalg.MatrixRankWarning)
+            x = linalg.spsolve((dvdy @ self._titrate_s).tocsc(), -v0)
+        return x if np.all(np.isfinite(x)) else None
 
     def simulate(self,
                  concs: Mapping[Molecule, float],
                  pH: float,
                  end: float,
                  step: float = 1e-7,
+                 backend: str = 'scipy',
                  **kwargs):
-        """Generate a timecourse of the dynamics of protonation/deprotonation from a given starting point."""
-
-        def dynamics(state):
-            return self.dstate_dt(self.rates(state))
-
-        fn = jax.jit(dynamics)
-        jac = jax.jit(jax.jacfwd(dynamics))
-
-        return integrate.solve_ivp(
-            fun=lambda _, y: fn(y),
-            jac=lambda _, y: jac(y),
-            y0=self.state_vector(concs, pH),
-            t_span=(0, end),
-            t_eval=np.linspace(0, end, int(end / step) + 1),
-            method='BDF',
-            first_step=1e-9,  # pH is fast
-            **kwargs
+        """Generate a timecourse of the dynamics of protonation/deprotonation from a given starting point.
+
+        Args:
+            concs: starting concentrations of molecules in the buffer system.
+            pH: starting pH.
+            end: the end time of the simulation, in seconds.
+            step: the interval between time points of the returned timecourse.
+            backend: 'scipy' to integrate via scipy.integrate.solve_ivp(method='BDF'), or 'diffrax' to run the whole
+                integration as a single jit-compiled JAX function. The latter requires the optional diffrax package.
+            kwargs: additional keyword args passed through to solve_ivp(); for backend='diffrax' these are limited to
+                rtol, atol, and max_steps. By default solve_ivp() uses the analytic sparse jacobian; pass jac=None to
+                estimate it by finite differences over jac_sparsity instead.
+
+        Returns:
+            A solve_ivp() result, or an equivalent object with t, y, success, and message attributes.
+        """
+        y0 = self.state_vector(concs, pH)
+        t_eval = np.linspace(0, end, int(end / step) + 1)
+        if backend == 'scipy':
+            # The analytic jacobian costs one sparse product per evaluation; even for hundreds of species it beats
+            # finite differences over the sparsity pattern by ~5x.
+            kwargs.setdefault('jac', lambda _, y: self.jacobian(y))
+            kwargs.setdefault('jac_sparsity', self.jac_sparsity)
+            return integrate.solve_ivp(
+                fun=lambda _, y: self._dynamics_host(y),
+                y0=np.asarray(y0),
+                t_span=(0, end),
+                t_eval=t_eval,
+                method='BDF',
+                first_step=1e-9,  # pH is fast
+                **kwargs
+            )
+        elif backend == 'diffrax':
+            return self._simulate_diffrax(y0, t_eval, **kwargs)
+        else:
+            raise ValueError(f"Unknown backend [{backend}]")
+
+    def _simulate_diffrax(self,
+                          y0: jnp.ndarray,
+                          t_eval: np.ndarray,
+                          rtol: float = 1e-3,
+                          atol: float = 1e-6,
+                          max_steps: int = 100000) -> optimize.OptimizeResult:
+        """Integrates the dynamics with a stiff diffrax solver, entirely within JAX."""
+        import diffrax
+
+        soln = _diffrax_solver()(y0, jnp.asarray(t_eval), self._params, rtol, atol, max_steps)
+        success = bool(soln.result == diffrax.RESULTS.successful)
+        return optimize.OptimizeResult(
+            t=np.asarray(soln.ts),
+            y=np.asarray(soln.ys).T,
+            success=success,
+            message='The solver successfully reached the end of the integration interval.' if success else str(
+                soln.result),
         )
@@ -146,6 +146,23 @@ class Session:
                 self._cache_value(dataset, doc)
         return self._cache[dataset].get(id)
 
+    def get_many(self, dataset: Dataset, ids: Iterable[str]) -> List[Optional[KbEntry]]:
+        """Retrieves any number of entries from the KB by ID, with at most one round-trip to the datastore.
+
+        Returns:
+            A list collinear with ids, holding the entry for each id, or None where it does not exist.
+        """
+        ids = list(ids)
+        if dataset is None:
+            return [None] * len(ids)
+
+        cache = self._cache[dataset]
+        missing = list({id for id in ids if id not in cache})
+        if missing and self.client is not None:
+            for doc in self.client[dataset.client_db][dataset.collection].find({'_id': {'$in': missing}}):
+                self._cache_value(dataset, doc)
+        return [cache.get(id) for id in ids]
+
     def deref(self, q: Union[DbXref, KbEntry, str], clazz: Optional[Type] = None) -> Optional[KbEntry]:
         """Retrieves the entry referred to by a DbXref or its string representation."""
         xref = _as_xref(q)
@@ -162,8 +179,7 @@ class Session:
         dataset, its db attribute will be updated. If it is already part of a different dataset, a copy will be
         persisted instead.
 
-        Note that changing an entry's db attribute changes how it tests equality, and how its hash is calculated.
-        Use with caution.
+        Note that changing an entry's db attribute changes how it tests equality. Use with caution.
 
         Args:
              dataset: the dataset where the entry will be persisted.
@@ -129,7 +129,9 @@ class KbEntry:
         return self.same_as(other)
 
     def __hash__(self):
-        return hash((type(self), self.id, self.db))
+        # Hash by id alone: it is cheap, and consistent with same_as(), which requires matching ids. It also leaves the
+        # hash unchanged when an entry is assigned to a db, e.g. when first persisted.
+        return hash(self.id)
 
     def __repr__(self):
         return f"[{self.id}]{' (' + self.shorthand + ')' if self.shorthand else ''} {self.name or ''}"
@@ -79,7 +79,7 @@ class Molecule(KbEntry):
         return self.same_as(other)
 
     def __hash__(self):
-        return hash((type(self), self.id))
+        return hash(self.id)
 
     def __repr__(self):
         return f"[{self.id}] {self.name or ''}"
@@ -123,7 +123,7 @@ class Reaction(KbEntry):
         return self.same_as(other)
 
     def __hash__(self):
-        return hash((type(self), self.id))
+        return hash(self.id)
 
     def __repr__(self):
         return f"[{self.id}] {self.equation}"
@@ -16,6 +16,7 @@ Some characteristics of typical reaction networks:
 from typing import Any, Iterable, Iterator, Mapping, Optional, Sequence, Tuple, TypeVar, Union
 
 import numpy as np
+from scipy import sparse
 
 from .base import KbEntry
 from .core import Molecule, Reaction
@@ -29,7 +30,7 @@ class Index(Sequence[KE]):
     An Index behaves as a list with set semantics, i.e. any item appears at most once and therefore has a unique
     numerical position. It is useful for moving back and forth between packed values in numerically-indexed vectors
     (e.g. numpy arrays) and the semantic objects represented at each position. Random access by position is supported
-    directly by subscripting. Random access by item is supported by index_of().
+    directly by subscripting. Random access by item is supported by index_of(), or indices_of() for many items.
     """
 
     def __init__(self, items: Optional[Iterable[KE]] = None):
@@ -68,9 +69,23 @@ class Index(Sequence[KE]):
         """Returns the numerical position of the item, or None if not present."""
         return self._index.get(item, None)
 
+    def indices_of(self, items: Iterable[KE]) -> np.ndarray:
+        """Returns the numerical positions of any number of items, as an integer array.
+
+        Raises:
+            KeyError if any item is not present.
+        """
+        return np.fromiter((self._index[item] for item in items), dtype=np.intp)
+
     def pack(self, data: Mapping[KE, Any], default: Any = 0) -> np.ndarray:
-        """Converts a dict of {item: value} to a 1D vector for numpy ops."""
-        return np.array([data.get(item, default) for item in self._items], dtype=float)
+        """Converts a dict of {item: value} to a 1D vector for numpy ops. Items not in the index are ignored."""
+        # Cost scales with the size of data rather than the index, which is typically much larger.
+        values = np.full(len(self._items), default, dtype=float)
+        for item, value in data.items():
+            i = self._index.get(item)
+            if i is not None:
+                values[i] = value
+        return values
 
     def unpack(self, values: Iterable[Any]) -> Mapping[KE, Any]:
         """Converts an array of values to an {item: value} dict."""
@@ -108,8 +123,10 @@ class Pathway(KbEntry):
         super().__init__(**kwargs)
         self.diagram = diagram
 
-        # Defer construction of the stoichiometry matrix until it is needed.
+        # Defer construction of the stoichiometry matrix (and reversibility) until it is needed.
         self._s_matrix = None
+        self._sparse_s_matrix = None
+        self._reversible_mask = None
 
         # Prepare indices for reactions and molecules.
         self.reactions: Index[Reaction] = Index()
@@ -127,21 +144,42 @@ class Pathway(KbEntry):
         self.reactions.add(reaction)
         self.molecules.update(reaction.stoichiometry.keys())
 
-        # Force reconstruction of the stoichiometry matrix.
+        # Force reconstruction of the stoichiometry matrix (and reversibility).
         self._s_matrix = None
+        self._sparse_s_matrix = None
+        self._reversible_mask = None
 
     @property
     def s_matrix(self) -> np.ndarray:
         """The 2D stoichiometry matrix describing this reaction network mathematically."""
         if self._s_matrix is None:
-            s_matrix = np.zeros(self.shape)
-            for reaction in self.reactions:
-                for molecule, coeff in reaction.stoichiometry.items():
-                    # (molecule, reaction) is guaranteed unique
-                    s_matrix[self.molecules.index_of(molecule), self.reactions.index_of(reaction)] = coeff
-            self._s_matrix = s_matrix
+            self._s_matrix = self.sparse_s_matrix.toarray()
         return self._s_matrix
 
+    @property
+    def sparse_s_matrix(self) -> sparse.csr_matrix:
+        """The stoichiometry matrix in compressed sparse row form, for efficient products with flux vectors."""
+        if self._sparse_s_matrix is None:
+            # Each reaction is one column, so reading all stoichiometries in order lays out the matrix in CSC form.
+            # (molecule, reaction) is guaranteed unique.
+            indptr = np.zeros(len(self.reactions) + 1, dtype=np.intp)
+            np.cumsum([len(reaction.stoichiometry) for reaction in self.reactions], out=indptr[1:])
+            indices = self.molecules.indices_of(
+                molecule for reaction in self.reactions for molecule in reaction.stoichiometry)
+            data = np.fromiter(
+                (coeff for reaction in self.reactions for coeff in reaction.stoichiometry.values()), dtype=float)
+            s_matrix = sparse.csc_matrix((data, indices, indptr), shape=self.shape)
+            self._sparse_s_matrix = s_matrix.tocsr()
+        return self._sparse_s_matrix
+
+    @property
+    def reversible_mask(self) -> np.ndarray:
+        """Boolean vector, collinear with reactions, indicating whether each reaction is reversible."""
+        if self._reversible_mask is None:
+            self._reversible_mask = np.fromiter(
+                (reaction.reversible for reaction in self.reactions), dtype=bool, count=len(self.reactions))
+        return self._reversible_mask
+
     @property
     def shape(self) -> Tuple[int, int]:
         """The 2D shape of this network, (#molecules, #reactions)."""
@@ -157,7 +195,7 @@ class Pathway(KbEntry):
         return self.same_as(other)
 
     def __hash__(self):
-        return hash((type(self), self.id))
+        return hash(self.id)
 
     def __add__(self, other):
         """Combines this network with another Pathway, or a single Reaction."""
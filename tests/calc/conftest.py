@@ -0,0 +1,10 @@
+"""Shared fixtures for tests of mosmo.calc."""
+import jax
+import pytest
+
+
+@pytest.fixture
+def x64():
+    """Enables double precision in JAX for the duration of a single test, so it does not leak into other tests."""
+    with jax.enable_x64(True):
+        yield
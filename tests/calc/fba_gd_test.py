@@ -0,0 +1,113 @@
+"""Tests for mosmo.calc.fba_gd."""
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from mosmo.model import Molecule, Reaction, Pathway
+from mosmo.calc.fba_gd import FbaGd, ProductionObjective, VelocityObjective, _levenberg_marquardt
+
+A = Molecule("A")
+B = Molecule("B")
+C = Molecule("C")
+D = Molecule("D")
+
+IN_A = Reaction("in_a", stoichiometry={A: 1})
+AB = Reaction("ab", stoichiometry={A: -1, B: 1})
+BC = Reaction("bc", stoichiometry={B: -1, C: 1}, reversible=False)
+BD = Reaction("bd", stoichiometry={B: -1, D: 1})
+
+# A single solution: 1.0 of B goes to C and 0.5 to D, so 1.5 of A comes in.
+NETWORK = Pathway(id="branch", reactions=[IN_A, AB, BC, BD])
+EXPECTED = np.array([1.5, 1.5, 1.0, 0.5])
+
+
+def _fba():
+    return FbaGd(NETWORK, [A, B], {'prod': ProductionObjective(NETWORK, {C: 1.0}),
+                                   'vel': VelocityObjective(NETWORK, {BD: 0.5})})
+
+
+@pytest.mark.usefixtures('x64')
+class TestFbaGd:
+    def test_Solve(self):
+        """Tests that both backends find the same, unique solution from the same starting point."""
+        fba = _fba()
+        v0 = np.ones(len(NETWORK.reactions))
+        soln_scipy = fba.solve(v0=v0, backend='scipy')
+        soln_jax = fba.solve(v0=v0, backend='jax')
+        np.testing.assert_allclose(soln_scipy.velocities, EXPECTED, atol=1e-6)
+        np.testing.assert_allclose(soln_jax.velocities, soln_scipy.velocities, atol=1e-6)
+        assert soln_jax.fit == pytest.approx(soln_scipy.fit, abs=1e-10)
+
+    def test_ConflictingTargets(self):
+        """Tests that conflicting targets are traded off with all residuals weighted equally, on both backends."""
+        fba = FbaGd(NETWORK, [A, B], {'prod': ProductionObjective(NETWORK, {C: 1.0}),
+                                      'vel': VelocityObjective(NETWORK, {IN_A: 0.5, BD: 0.5})})
+        for backend in ['scipy', 'jax']:
+            soln = fba.solve(v0=np.ones(len(NETWORK.reactions)), backend=backend)
+            np.testing.assert_allclose(soln.velocities, [0.7, 0.9, 0.8, 0.3], atol=1e-6)
+
+    def test_UnknownBackend(self):
+        """Tests that solve() rejects an unknown backend."""
+        with pytest.raises(ValueError):
+            _fba().solve(v0=np.ones(len(NETWORK.reactions)), backend='cobra')
+
+    def test_MaxNfev(self):
+        """Tests that the JAX optimizer stops after at most max_nfev iterations."""
+        def fun(x):
+            return jnp.array([10 * (x[1] - x[0] ** 2), 1 - x[0]])
+
+        x0 = jnp.array([-1.2, 1.0])
+        _, _, nfev = _levenberg_marquardt(fun, jax.jacfwd(fun), x0, max_nfev=3)
+        assert nfev == 3
+        x, cost, nfev = _levenberg_marquardt(fun, jax.jacfwd(fun), x0, max_nfev=1000)
+        assert nfev < 1000
+        np.testing.assert_allclose(x, [1.0, 1.0], atol=1e-4)
+        assert cost < 1e-8
+
+    def test_SolveBatch(self):
+        """Tests that each row of a batch solution matches solve() from the same starting point."""
+        fba = _fba()
+        v0s = np.asarray(jax.random.normal(jax.random.PRNGKey(0), (4, len(NETWORK.reactions))))
+        batch = fba.solve_batch(v0s=v0s)
+        assert batch.velocities.shape == (4, len(NETWORK.reactions))
+        assert batch.fit.shape == (4,)
+        for v0, velocities, fit in zip(v0s, batch.velocities, batch.fit):
+            soln = fba.solve(v0=v0, backend='jax')
+            np.testing.assert_allclose(velocities, soln.velocities, atol=1e-8)
+            assert fit == pytest.approx(soln.fit, abs=1e-10)
+
+    def test_SolveBatchUpdates(self):
+        """Tests that solve_batch() applies each update to its own solution, leaving the current params unchanged."""
+        fba = _fba()
+        params = [np.array(p) for p in fba.objectives['prod'].params()]
+        batch = fba.solve_batch(updates=[{'prod': {C: 1.0}}, {'prod': {C: 2.0}}], seed=jax.random.PRNGKey(0))
+        np.testing.assert_allclose(batch.velocities[:, 2], [1.0, 2.0], atol=1e-6)
+        for before, after in zip(params, fba.objectives['prod'].params()):
+            np.testing.assert_array_equal(before, after)
+
+    def test_UpdatedParams(self):
+        """Tests that updated_params() reflects an update without applying it to the objective."""
+        objective = ProductionObjective(NETWORK, {C: 1.0})
+        lb, ub = objective.updated_params({C: (0.5, 2.0)})
+        np.testing.assert_array_equal(lb, [0.5])
+        np.testing.assert_array_equal(ub, [2.0])
+        for bound in objective.params():
+            np.testing.assert_array_equal(bound, [1.0])
+
+    def test_SolveBatchMismatch(self):
+        """Tests that solve_batch() requires one starting point per update."""
+        with pytest.raises(ValueError):
+            _fba().solve_batch(v0s=np.ones((3, len(NETWORK.reactions))), updates=[{'prod': {C: 2.0}}])
+
+
+class TestDefaultPrecision:
+    def test_Solve(self):
+        """Tests both backends and solve_batch() without jax_enable_x64, i.e. in JAX's default single precision."""
+        assert jnp.zeros(1).dtype == jnp.float32
+        fba = _fba()
+        for backend in ['scipy', 'jax']:
+            np.testing.assert_allclose(
+                fba.solve(v0=np.ones(len(NETWORK.reactions)), backend=backend).velocities, EXPECTED, atol=1e-4)
+        batch = fba.solve_batch(num_starts=4, seed=jax.random.PRNGKey(0))
+        np.testing.assert_allclose(batch.velocities, np.tile(EXPECTED, (4, 1)), atol=1e-4)
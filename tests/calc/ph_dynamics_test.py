@@ -0,0 +1,114 @@
+"""Tests for mosmo.calc.ph_dynamics."""
+import jax
+import numpy as np
+import pytest
+
+from mosmo.model import Molecule
+from mosmo.calc.ph_dynamics import PhBuffer, ProtonationSequence, PROTON
+
+# A diprotic and a monoprotic buffer component, in order from most deprotonated to most protonated.
+A = [Molecule("A2-"), Molecule("HA-"), Molecule("H2A")]
+B = [Molecule("B-"), Molecule("HB")]
+C = [Molecule("C3-"), Molecule("HC2-"), Molecule("H2C-"), Molecule("H3C")]
+COMPONENTS = [ProtonationSequence(A, [4.5, 9.0]), ProtonationSequence(B, [7.2])]
+CONCS = {A[0]: 0.01, B[1]: 0.02}
+
+
+def _state(buffer, concs):
+    return np.array([concs[species] for species in buffer.species])
+
+
+@pytest.mark.usefixtures('x64')
+class TestPhBuffer:
+    def test_Equilibrium(self):
+        """Tests that equilibrium of a multi-component buffer zeroes all rates, with no negative concentrations."""
+        buffer = PhBuffer(COMPONENTS + [ProtonationSequence(C, [2.1, 7.2, 12.3])])
+        state = _state(buffer, buffer.equilibrium({**CONCS, C[3]: 0.005}, 7.0))
+        assert np.all(state >= 0)
+        forward = buffer.kf * state[buffer.acids]
+        np.testing.assert_allclose(buffer.rates(state), 0, atol=1e-10 * forward.max())
+
+    def test_Titrate(self):
+        """Tests that titration holds [H+] fixed, conserves each component, and brings all rates to zero."""
+        buffer = PhBuffer(COMPONENTS)
+        state = _state(buffer, buffer.titrate(CONCS, 6.0))
+        assert state[buffer.species.index(PROTON)] == pytest.approx(1e-6)
+        for component in COMPONENTS:
+            total = sum(CONCS.get(species, 0) for species in component.species)
+            assert sum(state[buffer.species.index(species)] for species in component.species) == pytest.approx(total)
+        forward = buffer.kf * state[buffer.acids]
+        np.testing.assert_allclose(buffer.rates(state), 0, atol=1e-10 * forward.max())
+
+    def test_TitrateFallback(self):
+        """Tests that the direct linear solution for titration agrees with the least_squares fallback."""
+        buffer = PhBuffer(COMPONENTS)
+        direct = _state(buffer, buffer.titrate(CONCS, 6.0))
+        buffer._titrate_direct = lambda state0: None
+        fallback = _state(buffer, buffer.titrate(CONCS, 6.0))
+        np.testing.assert_allclose(fallback, direct, rtol=1e-6, atol=1e-12)
+
+    def test_Float32(self):
+        """Tests titrate and equilibrium in single precision against double precision, within float32 tolerances."""
+        buffer64 = PhBuffer(COMPONENTS)
+        buffer32 = PhBuffer(COMPONENTS, dtype=np.float32)
+        np.testing.assert_allclose(_state(buffer32, buffer32.titrate(CONCS, 6.0)),
+                                   _state(buffer64, buffer64.titrate(CONCS, 6.0)), rtol=1e-4)
+        state32 = _state(buffer32, buffer32.equilibrium(CONCS, 7.0))
+        state64 = _state(buffer64, buffer64.equilibrium(CONCS, 7.0))
+        assert np.log10(state32[0]) == pytest.approx(np.log10(state64[0]), abs=0.01)
+        np.testing.assert_allclose(state32[3:], state64[3:], rtol=1e-2)
+
+    def test_Jacobian(self):
+        """Tests the analytic sparse jacobian against JAX autodiff, and against the declared sparsity pattern."""
+        buffer = PhBuffer(COMPONENTS)
+        state = np.asarray(buffer.state_vector(CONCS, 6.0))
+        jacobian = buffer.jacobian(state)
+        np.testing.assert_allclose(jacobian.toarray(), jax.jacfwd(buffer.dynamics)(state), rtol=1e-12, atol=1e-12)
+        rows, cols = jacobian.nonzero()
+        assert np.all(buffer.jac_sparsity.toarray()[rows, cols])
+
+    def test_StateFromArray(self):
+        """Tests that state_from_array matches state_vector, and rejects concentrations of the wrong shape."""
+        buffer = PhBuffer(COMPONENTS)
+        concs = np.array([CONCS.get(species, 0) for species in buffer.species[3:]])
+        np.testing.assert_array_equal(buffer.state_from_array(concs, 6.0), buffer.state_vector(CONCS, 6.0))
+        with pytest.raises(ValueError):
+            buffer.state_from_array(np.zeros(len(buffer.species)), 6.0)
+        with pytest.raises(ValueError):
+            buffer.state_from_array(0.01, 6.0)
+
+    def test_Simulate(self):
+        """Tests that simulation with the analytic jacobian agrees with finite differences over jac_sparsity."""
+        buffer = PhBuffer(COMPONENTS)
+        analytic = buffer.simulate(CONCS, 7.0, 1e-5, step=1e-6, rtol=1e-8, atol=1e-14)
+        estimated = buffer.simulate(CONCS, 7.0, 1e-5, step=1e-6, jac=None, rtol=1e-8, atol=1e-14)
+        assert analytic.success and estimated.success
+        assert analytic.y.shape == (len(buffer.species), 11)
+        np.testing.assert_allclose(estimated.y, analytic.y, rtol=1e-6, atol=1e-12)
+
+    def test_SimulateDiffrax(self):
+        """Tests that the diffrax backend agrees with solve_ivp on the same timecourse."""
+        pytest.importorskip('diffrax')
+        buffer = PhBuffer(COMPONENTS)
+        scipy_soln = buffer.simulate(CONCS, 7.0, 1e-5, step=1e-6, rtol=1e-8, atol=1e-14)
+        diffrax_soln = buffer.simulate(CONCS, 7.0, 1e-5, step=1e-6, backend='diffrax', rtol=1e-8, atol=1e-14)
+        assert diffrax_soln.success
+        np.testing.assert_allclose(diffrax_soln.t, scipy_soln.t)
+        np.testing.assert_allclose(diffrax_soln.y, scipy_soln.y, rtol=1e-6, atol=1e-12)
+
+    def test_SimulateUnknownBackend(self):
+        """Tests that simulate() rejects an unknown backend."""
+        with pytest.raises(ValueError):
+            PhBuffer(COMPONENTS).simulate(CONCS, 7.0, 1e-5, step=1e-6, backend='odeint')
+
+
+class TestDefaultPrecision:
+    def test_Equilibrium(self):
+        """Tests equilibrium without jax_enable_x64 against double precision, within float32 tolerances."""
+        buffer = PhBuffer(COMPONENTS)
+        state = _state(buffer, buffer.equilibrium(CONCS, 7.0))
+        with jax.enable_x64(True):
+            buffer64 = PhBuffer(COMPONENTS)
+            state64 = _state(buffer64, buffer64.equilibrium(CONCS, 7.0))
+        assert np.log10(state[0]) == pytest.approx(np.log10(state64[0]), abs=0.01)
+        np.testing.assert_allclose(state[3:], state64[3:], rtol=1e-2)
@@ -56,6 +56,17 @@ class TestSession:
         assert len(session._cache[TEST]) == 2
         assert session.get(TEST, "obj1") is obj1
 
+    def test_GetMany(self):
+        """The KB retrieves multiple entries at once, in order, with None for missing entries."""
+        session = self.mem_session()
+        obj1 = KbEntry("obj1", name="Test object 1")
+        obj2 = KbEntry("obj2", name="Test object 2")
+        with session.unlock(TEST):
+            session.put(TEST, obj1)
+            session.put(TEST, obj2)
+
+        assert session.get_many(TEST, ["obj2", "nope", "obj1"]) == [obj2, None, obj1]
+
     def test_DerefObj(self):
         """The KB can dereference a DbXref."""
         session = self.mem_session()
@@ -36,6 +36,13 @@ class TestKbEntry:
         assert counts[a] == 3
         assert counts[b] == 1
 
+    def test_HashIgnoresDb(self):
+        """Assigning an entry to a db does not change its hash, so it can still be found in sets and dicts."""
+        a = KbEntry("a")
+        entries = {a}
+        a.db = DS.get("STUFF")
+        assert a in entries
+
 
 class TestDbXref:
     def test_FromStr(self):
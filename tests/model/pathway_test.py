@@ -2,6 +2,7 @@
 from dataclasses import dataclass
 
 import numpy as np
+import pytest
 
 from mosmo.model import KbEntry, Molecule, Reaction, Pathway, Index
 
@@ -51,10 +52,17 @@ class TestIndex:
         assert len(tidbits) == 3
         assert tidbits.index_of(T3) == 2
 
+    def test_IndicesOf(self):
+        """Positions of multiple items are returned as an integer array, in the requested order."""
+        tidbits: Index[_Tidbit] = Index([T1, T2, T3])
+        assert np.array_equal(tidbits.indices_of([T3, T1]), [2, 0])
+        with pytest.raises(KeyError):
+            tidbits.indices_of([T1, _Tidbit("t4")])
+
     def test_Pack(self):
         tidbits: Index[_Tidbit] = Index([T1, T2, T3])
         v = tidbits.pack({T2: 3}, default=-1)
-        assert np.all(v == np.array([-1, 3, -1]))
+        assert np.array_equal(v, [-1, 3, -1])
 
     def test_Unpack(self):
         tidbits: Index[_Tidbit] = Index([T2, T3, T1])  # Changed order
@@ -64,8 +72,9 @@ class TestIndex:
         assert data[T3] == 2.71828
 
 
-ABCD = Reaction("abcd", stoichiometry={Molecule("a"): -1, Molecule("b"): -2, Molecule("c"): 2, Molecule("d"): 1})
-BDE = Reaction("bde", stoichiometry={Molecule("b"): -1, Molecule("d"): -1, Molecule("e"): 2})
+A, B, C, D, E = (Molecule(id) for id in "abcde")
+ABCD = Reaction("abcd", stoichiometry={A: -1, B: -2, C: 2, D: 1})
+BDE = Reaction("bde", stoichiometry={B: -1, D: -1, E: 2})
 
 
 class TestPathway:
@@ -81,3 +90,21 @@ class TestPathway:
         for i, m in enumerate(network.molecules):
             for j, r in enumerate(network.reactions):
                 assert network.s_matrix[i, j] == r.stoichiometry.get(m, 0)
+
+    def test_SparseSMatrix(self):
+        """The sparse_s_matrix has the same values as the dense s_matrix, and tracks added reactions."""
+        network = Pathway([ABCD])
+        assert np.array_equal(network.sparse_s_matrix.toarray(), network.s_matrix)
+
+        network.add_reaction(BDE)
+        assert network.sparse_s_matrix.shape == network.shape
+        assert network.sparse_s_matrix.nnz == 7
+        assert np.array_equal(network.sparse_s_matrix.toarray(), network.s_matrix)
+
+    def test_ReversibleMask(self):
+        """The reversible_mask matches the reversibility of the input reactions, and tracks added reactions."""
+        network = Pathway([ABCD, BDE])
+        assert np.array_equal(network.reversible_mask, [True, True])
+
+        network.add_reaction(Reaction("ea", stoichiometry={E: -1, A: 1}, reversible=False))
+        assert np.array_equal(network.reversible_mask, [True, True, False])